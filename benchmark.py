@@ -0,0 +1,349 @@
+# Offline benchmarks for main.py: a stub Nominatim, fixture polygons and mongomock, so no network or Mongo is needed.
+#   python benchmark.py          run every benchmark and print the timings
+#   python benchmark.py --check  run only the request pipeline and exit 1 if a median is over its budget (CI runs this)
+import os
+import sys
+import json
+import argparse
+import time
+import statistics
+import tempfile
+import threading
+import tracemalloc
+import contextlib
+import io
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import folium
+import mongomock
+import numpy as np
+from folium.plugins import MarkerCluster
+from shapely.geometry import Point, Polygon, mapping
+
+os.environ.setdefault('POLYGON_CACHE_DIR', tempfile.mkdtemp(prefix='polygon_cache_'))
+
+
+class StubNominatim(BaseHTTPRequestHandler):
+  # Answers searches after a delay similar to the real service: 'Fixture City <n>' gets fixture polygon n,
+  # anything else the same square city
+  delay = 0.2
+  requests_served = 0
+
+  def do_GET(self):
+    StubNominatim.requests_served += 1
+    time.sleep(self.delay)
+    query = parse_qs(urlparse(self.path).query).get('q', [''])[0]
+    if query.startswith('Fixture City '):
+      geojson = mapping(fixture_polygon(int(query.rsplit(' ', 1)[1])))
+    else:
+      geojson = {'type': 'Polygon', 'coordinates': [[[-87.8, 41.7], [-87.6, 41.7], [-87.6, 41.9], [-87.8, 41.9], [-87.8, 41.7]]]}
+    body = json.dumps([{
+      'lat': '41.8', 'lon': '-87.7', 'display_name': query or 'Stub City', 'boundingbox': ['41.7', '41.9', '-87.8', '-87.6'],
+      'geojson': geojson,
+    }]).encode('utf-8')
+    self.send_response(200)
+    self.send_header('Content-Type', 'application/json')
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, *args):
+    pass
+
+
+stub_server = ThreadingHTTPServer(('127.0.0.1', 0), StubNominatim)
+threading.Thread(target=stub_server.serve_forever, daemon=True).start()
+os.environ['NOMINATIM_DOMAIN'] = f'127.0.0.1:{stub_server.server_port}'
+os.environ['NOMINATIM_SCHEME'] = 'http'
+# The stub has no usage policy, so the benchmarks do not need to space out requests
+os.environ.setdefault('NOMINATIM_CONCURRENCY', '8')
+os.environ.setdefault('NOMINATIM_MIN_INTERVAL', '0')
+
+import main
+
+
+def create_grid_loop(city_polygon):
+  # The original per-point implementation of create_grid, kept as the baseline
+  minx, miny, maxx, maxy = city_polygon.bounds
+  nx = round((maxx - minx) * 69)
+  ny = round((maxy - miny) * 69)
+  x_coords = np.linspace(minx, maxx, nx)
+  y_coords = np.linspace(miny, maxy, ny)
+  grid_points = []
+  for x in x_coords:
+    for y in y_coords:
+      if city_polygon.contains(Point(x, y)):
+        grid_points.append((x, y))
+  return grid_points
+
+
+def synthetic_polygon(radius, vertices):
+  # A wobbly disc centred near Chicago, so both the area and the boundary complexity can grow
+  angles = np.linspace(0, 2 * np.pi, vertices, endpoint=False)
+  radii = radius * (1 + 0.15 * np.sin(7 * angles))
+  return Polygon(np.column_stack((-87.7 + radii * np.cos(angles), 41.8 + radii * np.sin(angles))))
+
+
+def fixture_polygon(n):
+  # Offline stand-ins for real city outlines, from a small town to a large metro
+  return synthetic_polygon(0.05 + 0.05 * n, 4096)
+
+
+def time_call(func, *args):
+  start = time.perf_counter()
+  with contextlib.redirect_stdout(io.StringIO()):
+    result = func(*args)
+  return time.perf_counter() - start, result
+
+
+def bench_create_grid():
+  print(f"{'radius':>8} {'vertices':>9} {'points':>8} {'loop (s)':>10} {'vector (s)':>11} {'speedup':>8}")
+  for radius in (0.25, 0.5, 1.0, 2.0):
+    for vertices in (64, 1024, 16384):
+      polygon = synthetic_polygon(radius, vertices)
+      loop_time, loop_points = time_call(create_grid_loop, polygon)
+      # Same ~1 mile spacing as the loop, so both sides test a comparable number of points
+      vector_time, vector_points = time_call(main.create_grid, polygon, 1609.344)
+      print(f"{radius:>8} {vertices:>9} {len(vector_points):>8} {loop_time:>10.4f} "
+            f"{vector_time:>11.4f} {loop_time / vector_time:>7.1f}x")
+
+
+def bench_grid_layouts():
+  # Points needed for the same worst-case distance at different latitudes, old 69 mi/degree grid vs metric layouts
+  print(f"{'latitude':>9} {'69/deg':>8} {'square':>8} {'hexagonal':>10} {'sq cover':>9} {'hex cover':>10}")
+  for latitude in (0, 30, 45, 60):
+    polygon = Point(-87.7, latitude).buffer(0.5, 64)
+    with contextlib.redirect_stdout(io.StringIO()):
+      old_points = create_grid_loop(polygon)
+      square = main.create_grid(polygon, 1609.344, 'square')
+      hexagonal = main.create_grid(polygon, 1609.344, 'hexagonal')
+    square_cover = main.grid_coverage_ratio(polygon, len(square), 1609.344, 'square')
+    hex_cover = main.grid_coverage_ratio(polygon, len(hexagonal), 1609.344, 'hexagonal')
+    print(f"{latitude:>9} {len(old_points):>8} {len(square):>8} {len(hexagonal):>10} {square_cover:>9} {hex_cover:>10}")
+
+
+def bench_polygon_cache():
+  # 32 concurrent lookups over 4 cities, then the same after a restart (memory cleared, disk kept)
+  cities = [f'City {i % 4}' for i in range(32)]
+  for label in ('cold', 'memory', 'disk'):
+    if label == 'disk':
+      main.polygon_cache.memory.clear()
+    served_before = StubNominatim.requests_served
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()), ThreadPoolExecutor(16) as executor:
+      list(executor.map(main.polygon_cache.get, cities))
+    elapsed = time.perf_counter() - start
+    print(f"{label:>7}: {len(cities)} lookups, {StubNominatim.requests_served - served_before} Nominatim requests, {elapsed:.3f} s")
+  print(main.polygon_cache.stats())
+
+
+class CountingCollection:
+  # Wraps a collection and counts every call that goes to the server; cursors count once
+  def __init__(self, collection):
+    self.collection = collection
+    self.round_trips = 0
+
+  def __getattr__(self, name):
+    method = getattr(self.collection, name)
+
+    def call(*args, **kwargs):
+      self.round_trips += 1
+      return method(*args, **kwargs)
+    return call
+
+
+def mongo_client():
+  # Set BENCHMARK_MONGO_URI to run against a real mongod instead of mongomock
+  uri = os.environ.get('BENCHMARK_MONGO_URI')
+  if uri:
+    import pymongo
+    return pymongo.MongoClient(uri)
+  return mongomock.MongoClient()
+
+
+def save_urls_one_by_one(collection, urls, generation_time):
+  # The original write path: one insert per URL
+  for url in urls:
+    collection.insert_one({'url': url, 'generation_time': generation_time})
+
+
+def load_urls_one_by_one(collection):
+  # The original read path: two counts, an unprojected scan and a find_one
+  collection.count_documents({})
+  collection.count_documents({'generation_time': {'$exists': True}})
+  urls = [doc['url'] for doc in collection.find()]
+  collection.find_one({'generation_time': {'$exists': True}})
+  return urls
+
+
+def bench_mongo_storage():
+  database = mongo_client()['benchmark_storage']
+  print(f"{'points':>8} {'layout':>10} {'write trips':>12} {'write (s)':>10} {'read trips':>11} {'read (s)':>9}")
+  for radius in (0.1, 0.25, 0.5):
+    with contextlib.redirect_stdout(io.StringIO()):
+      points = main.create_grid(synthetic_polygon(radius, 256), 500)
+    urls = [main.generate_google_maps_url('Stub City', 'pizza', point) for point in points]
+    for layout in ('per-url', 'packed'):
+      database.drop_collection(layout)
+      collection = CountingCollection(database[layout])
+      start = time.perf_counter()
+      if layout == 'per-url':
+        save_urls_one_by_one(collection, urls, 'now')
+      else:
+        main.save_grid(collection, points, {'generation_time': 'now'})
+      write_time, write_trips = time.perf_counter() - start, collection.round_trips
+      collection.round_trips = 0
+      start = time.perf_counter()
+      if layout == 'per-url':
+        load_urls_one_by_one(collection)
+      else:
+        stored = main.load_grid_points(collection, main.load_metadata(collection))
+        [main.generate_google_maps_url('Stub City', 'pizza', point) for point in stored]
+      read_time = time.perf_counter() - start
+      print(f"{len(points):>8} {layout:>10} {write_trips:>12} {write_time:>10.3f} {collection.round_trips:>11} {read_time:>9.3f}")
+
+
+def bench_url_responses():
+  # Peak Python memory and time to first byte for /generate/urls on large stored grids
+  client = mongo_client()
+  main.mongo = type('StubPyMongo', (), {'cx': client, 'db': client['benchmark_responses']})()
+  app_client = main.app.test_client()
+  print(f"{'points':>8} {'format':>7} {'first byte (s)':>15} {'total (s)':>10} {'peak MB':>8} {'body MB':>8}")
+  for size in (10000, 100000, 300000):
+    city = f'Synthetic {size}'
+    rng = np.random.default_rng(size)
+    points = np.column_stack((rng.uniform(-88, -87, size), rng.uniform(41, 42, size)))
+    main.save_grid(main.grid_collection(city), points, {
+      'city': city, 'layout': 'square', 'spacing_m': None, 'zoom': main.DEFAULT_ZOOM,
+      'coverage_ratio': None, 'generation_time': 'benchmark'})
+    for output_format in main.OUTPUT_FORMATS:
+      tracemalloc.start()
+      start = time.perf_counter()
+      with contextlib.redirect_stdout(io.StringIO()):
+        response = app_client.post('/generate/urls', buffered=False, json={
+          'city_name': city, 'location_of_interest': 'pizza', 'format': output_format})
+        pieces = iter(response.response)
+        body_size = len(next(pieces))
+        first_byte = time.perf_counter() - start
+        for piece in pieces:
+          body_size += len(piece)
+      total = time.perf_counter() - start
+      peak = tracemalloc.get_traced_memory()[1]
+      tracemalloc.stop()
+      print(f"{size:>8} {output_format:>7} {first_byte:>15.3f} {total:>10.3f} {peak / 1e6:>8.1f} {body_size / 1e6:>8.1f}")
+
+
+@contextlib.contextmanager
+def stdout_fd_silenced():
+  # Spawned worker processes write to file descriptor 1 directly, past redirect_stdout
+  sys.stdout.flush()
+  saved = os.dup(1)
+  with open(os.devnull, 'w') as devnull:
+    os.dup2(devnull.fileno(), 1)
+  try:
+    yield
+  finally:
+    os.dup2(saved, 1)
+    os.close(saved)
+
+
+def bench_batch_scaling():
+  # Grid throughput for a batch of fixture cities as worker processes are added
+  polygons = {f'city {i}': synthetic_polygon(0.3 + 0.05 * (i % 5), 2048) for i in range(24)}
+  cores = os.cpu_count() or 1
+  print(f"{'workers':>8} {'cities':>7} {'total (s)':>10} {'cities/s':>9}   ({cores} cores available)")
+  for workers in sorted({1, 2, 4, 8, cores}):
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()), stdout_fd_silenced():
+      results = main.create_grids(polygons, 500, 'hexagonal', workers=workers)
+    elapsed = time.perf_counter() - start
+    assert not any(isinstance(result, Exception) for result in results.values())
+    print(f"{workers:>8} {len(polygons):>7} {elapsed:>10.3f} {len(polygons) / elapsed:>9.1f}")
+
+
+def plot_grid_points_one_by_one(grid_points):
+  # The original map: one CircleMarker object per point inside a MarkerCluster
+  folium_map = folium.Map(location=[grid_points[0][1], grid_points[0][0]], zoom_start=13)
+  marker_cluster = MarkerCluster().add_to(folium_map)
+  for point in grid_points:
+    folium.CircleMarker([point[1], point[0]], radius=1, color="red").add_to(marker_cluster)
+  return folium_map
+
+
+def bench_map_rendering():
+  print(f"{'points':>8} {'map':>11} {'build (s)':>10} {'render (s)':>11} {'HTML MB':>8}")
+  for radius in (0.1, 0.25, 0.5):
+    with contextlib.redirect_stdout(io.StringIO()):
+      points = main.create_grid(synthetic_polygon(radius, 256), 500)
+    for label, plot in (('per-point', plot_grid_points_one_by_one), ('fast', main.plot_grid_points)):
+      with contextlib.redirect_stdout(io.StringIO()):
+        build_time, folium_map = time_call(plot, points)
+      render_time, html = time_call(lambda: folium_map.get_root().render())
+      print(f"{len(points):>8} {label:>11} {build_time:>10.3f} {render_time:>11.3f} {len(html) / 1e6:>8.1f}")
+
+
+# Median seconds per request that the offline pipeline must stay under for --check to pass, about 4x the
+# medians measured on a 1-core dev container (new city 0.36, new keyword 0.0035, ndjson stream 0.0035,
+# map 0.021). 'new city' includes the stub Nominatim's 0.2 s delay. Re-measure with `python benchmark.py`
+# when the pipeline changes; BENCHMARK_BUDGET_SCALE loosens them on a slower machine.
+PIPELINE_BUDGETS = {'new city': 1.2, 'new keyword': 0.015, 'ndjson stream': 0.015, 'map': 0.08}
+BUDGET_SCALE = float(os.environ.get('BENCHMARK_BUDGET_SCALE', 1))
+# Cheap requests are repeated per city so their medians rest on more samples; the map is not, as a repeat
+# would only time its HTML cache
+PIPELINE_REPEATS = {'new city': 1, 'new keyword': 5, 'ndjson stream': 5, 'map': 1}
+
+
+def bench_pipeline(check=False):
+  # The whole request path offline: stub Nominatim, fixture polygons and mongomock
+  client = mongomock.MongoClient()
+  main.mongo = type('StubPyMongo', (), {'cx': client, 'db': client['benchmark_pipeline']})()
+  main.MAP_CACHE_DIR = tempfile.mkdtemp(prefix='map_cache_')
+  main.polygon_cache.memory.clear()
+  main.polygon_cache.directory = tempfile.mkdtemp(prefix='polygon_cache_')
+  main.stage_metrics.clear()
+  app_client = main.app.test_client()
+  requests_timed = {name: [] for name in PIPELINE_BUDGETS}
+  with contextlib.redirect_stdout(io.StringIO()):
+    for n in range(6):
+      city = f'Fixture City {n}'
+      for name, call in (
+        ('new city', lambda: app_client.post('/generate/urls', json={'city_name': city, 'location_of_interest': 'pizza', 'wait': True})),
+        ('new keyword', lambda: app_client.post('/generate/urls', json={'city_name': city, 'location_of_interest': 'sushi'})),
+        ('ndjson stream', lambda: app_client.post('/generate/urls', json={'city_name': city, 'location_of_interest': 'bars', 'format': 'ndjson'})),
+        ('map', lambda: app_client.get('/map', query_string={'city': city})),
+      ):
+        for _ in range(PIPELINE_REPEATS[name]):
+          elapsed, _ = time_call(lambda: call().get_data())
+          requests_timed[name].append(elapsed)
+  print(f"{'request':>14} {'median (s)':>11} {'max (s)':>8} {'budget (s)':>11}")
+  failures = []
+  for name, times in requests_timed.items():
+    median = statistics.median(times)
+    budget = PIPELINE_BUDGETS[name] * BUDGET_SCALE
+    print(f"{name:>14} {median:>11.4f} {max(times):>8.4f} {budget:>11.4f}")
+    if median > budget:
+      failures.append(name)
+  print(f"{'stage':>14} {'count':>6} {'mean (s)':>9} {'max (s)':>8}")
+  for stage, metric in app_client.get('/metrics').get_json()['stages'].items():
+    print(f"{stage:>14} {metric['count']:>6} {metric['mean_s']:>9.4f} {metric['max_s']:>8.4f}")
+  if check and failures:
+    print(f"Over budget: {', '.join(failures)}")
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Offline benchmarks for main.py.')
+  parser.add_argument('--check', action='store_true', help='only run the pipeline benchmark and fail if it is over budget')
+  args = parser.parse_args()
+  if args.check:
+    bench_pipeline(check=True)
+    sys.exit(0)
+  bench_pipeline()
+  bench_create_grid()
+  bench_grid_layouts()
+  bench_polygon_cache()
+  bench_mongo_storage()
+  bench_url_responses()
+  bench_batch_scaling()
+  bench_map_rendering()
@@ -1,89 +1,406 @@
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request
 import os
-import requests
-from geopy.geocoders import Nominatim
-from shapely.geometry import shape, Point
-from fake_useragent import UserAgent, FakeUserAgentError
+import io
+import csv
+import json
+import base64
+import math
+import sys
+import hashlib
+import threading
+import time
+import uuid
+import argparse
+import contextlib
+import contextvars
+from collections import OrderedDict
+import multiprocessing
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor
+import shapely
 import numpy as np
-import folium
-from folium.plugins import MarkerCluster
-from flask_pymongo import PyMongo
 from datetime import datetime
+# geopy, fake_useragent, pyproj, folium and flask_pymongo are imported where they are used,
+# so starting the app or the CLI does not pay for libraries a request may never need
+
+# Cumulative timings of each pipeline stage since startup, served by /metrics
+stage_metrics = {}  # stage -> {'count', 'total_s', 'max_s'}
+stage_metrics_lock = threading.Lock()
+# Timings of the request or job running in the current context, if one is being recorded
+current_timings = contextvars.ContextVar('current_timings', default=None)
+
+def record_stage(stage, seconds):
+  # Adds a stage's seconds to /metrics and to the timings being recorded in this context, if any
+  with stage_metrics_lock:
+    metric = stage_metrics.setdefault(stage, {'count': 0, 'total_s': 0.0, 'max_s': 0.0})
+    metric['count'] += 1
+    metric['total_s'] += seconds
+    metric['max_s'] = max(metric['max_s'], seconds)
+  timings = current_timings.get()
+  if timings is not None:
+    timings[stage] = timings.get(stage, 0.0) + seconds
+
+@contextlib.contextmanager
+def timed(stage):
+  start = time.perf_counter()
+  try:
+    yield
+  finally:
+    record_stage(stage, time.perf_counter() - start)
+
+@contextlib.contextmanager
+def recording_timings(timings):
+  # Timed stages inside this block add themselves to timings. The previous value is restored on the way out
+  # so a pooled thread never carries one request's timings into the next.
+  token = current_timings.set(timings)
+  try:
+    yield timings
+  finally:
+    current_timings.reset(token)
+
+def rounded_timings(timings):
+  return {stage: round(seconds, 4) for stage, seconds in timings.items()}
+
+FALLBACK_USERAGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3'
+_useragent = None
 
 def get_random_useragent():
+  # Loading the UserAgent database is slow, so it is done once and reused
+  global _useragent
+  from fake_useragent import UserAgent, FakeUserAgentError
   try:
-    ua = UserAgent()
-    return ua.random
+    if _useragent is None:
+      _useragent = UserAgent()
+    return _useragent.random
   except FakeUserAgentError:
-    return 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3'
+    return FALLBACK_USERAGENT
+
+# Point these at a local stub server to test without hitting OpenStreetMap
+NOMINATIM_DOMAIN = os.environ.get('NOMINATIM_DOMAIN', 'nominatim.openstreetmap.org')
+NOMINATIM_SCHEME = os.environ.get('NOMINATIM_SCHEME', 'https')
+# Seconds to wait for a geocode; outlines of large metros are several MB, far beyond geopy's 1 s default
+NOMINATIM_TIMEOUT = float(os.environ.get('NOMINATIM_TIMEOUT', 30))
+# Nominatim's usage policy allows one request per second from one application
+NOMINATIM_CONCURRENCY = int(os.environ.get('NOMINATIM_CONCURRENCY', 1))
+NOMINATIM_MIN_INTERVAL = float(os.environ.get('NOMINATIM_MIN_INTERVAL', 1.0))
+nominatim_slots = threading.BoundedSemaphore(NOMINATIM_CONCURRENCY)
+_nominatim_lock = threading.Lock()
+_next_nominatim_request = 0.0
+
+def wait_for_nominatim_turn():
+  # Spaces requests at least NOMINATIM_MIN_INTERVAL seconds apart across all threads
+  global _next_nominatim_request
+  with _nominatim_lock:
+    now = time.monotonic()
+    turn = max(now, _next_nominatim_request)
+    _next_nominatim_request = turn + NOMINATIM_MIN_INTERVAL
+  time.sleep(turn - now)
 
 def get_city_polygon(city):
   try:
     print("Getting city polygon...")
-    geolocator = Nominatim(user_agent=get_random_useragent())
-    location = geolocator.geocode(city)
+    from geopy.geocoders import Nominatim
+    from shapely.geometry import shape
+    geolocator = Nominatim(user_agent=get_random_useragent(), domain=NOMINATIM_DOMAIN, scheme=NOMINATIM_SCHEME)
+    # Ask for the outline in the same request instead of a second search.php round trip
+    with nominatim_slots:
+      wait_for_nominatim_turn()
+      with timed('geocode'):
+        location = geolocator.geocode(city, geometry='geojson', timeout=NOMINATIM_TIMEOUT)
     if location is not None:
       print(f"Found location: {location}")
-      url = f'https://nominatim.openstreetmap.org/search.php?q={location.address}&polygon_geojson=1&format=jsonv2'
-      headers = {'User-Agent': get_random_useragent()}
-      response = requests.get(url, headers=headers)
-      response_json = response.json()
-      if response_json:
-        print(f"Response JSON: {response_json}")
-        polygon_geojson = response_json[0]['geojson']
+      polygon_geojson = location.raw.get('geojson')
+      if polygon_geojson:
         polygon = shape(polygon_geojson)
-        print(f"Got city polygon: {polygon}")
+        print(f"Got city polygon: {polygon.geom_type} with bounds {polygon.bounds}")
         return polygon
   except Exception as e:
     print(f"An error occurred while getting the city polygon for {city}: {e}")
     return None
 
-def create_grid(city_polygon):
+class PolygonCache:
+  """Two-level cache of city polygons: an in-process LRU of prepared geometries in front of WKB files on disk.
+
+  Entries older than ttl seconds are refetched. Concurrent misses for the same city wait on a single fetch.
+  """
+
+  def __init__(self, loader, directory, ttl, max_entries, max_files):
+    self.loader = loader
+    self.directory = directory
+    self.ttl = ttl
+    self.max_entries = max_entries
+    self.max_files = max_files
+    self.memory = OrderedDict()  # key -> (fetched_at, polygon)
+    self.in_flight = {}  # key -> threading.Event set when the fetch finishes
+    self.lock = threading.Lock()
+    self.counters = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'waits': 0, 'fetch_errors': 0}
+
+  @staticmethod
+  def key(city):
+    return ' '.join(city.lower().split())
+
+  def path(self, key):
+    return os.path.join(self.directory, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.wkb')
+
+  def get(self, city):
+    key = self.key(city)
+    with self.lock:
+      polygon = self._from_memory(key)
+      if polygon is not None:
+        self.counters['memory_hits'] += 1
+        return polygon
+      event = self.in_flight.get(key)
+      waiting = event is not None
+      if waiting:
+        self.counters['waits'] += 1
+      else:
+        event = self.in_flight[key] = threading.Event()
+    if waiting:
+      # Another request is already fetching this city; share its result, or its failure
+      event.wait()
+      with self.lock:
+        return self._from_memory(key)
+    try:
+      return self._load(key, city)
+    finally:
+      with self.lock:
+        del self.in_flight[key]
+      event.set()
+
+  def _from_memory(self, key):
+    entry = self.memory.get(key)
+    if entry is None:
+      return None
+    fetched_at, polygon = entry
+    if time.time() - fetched_at > self.ttl:
+      del self.memory[key]
+      return None
+    self.memory.move_to_end(key)
+    return polygon
+
+  def _remember(self, key, fetched_at, polygon):
+    shapely.prepare(polygon)
+    with self.lock:
+      self.memory[key] = (fetched_at, polygon)
+      self.memory.move_to_end(key)
+      while len(self.memory) > self.max_entries:
+        self.memory.popitem(last=False)
+
+  def _load(self, key, city):
+    path = self.path(key)
+    try:
+      fetched_at = os.path.getmtime(path)
+      if time.time() - fetched_at <= self.ttl:
+        with open(path, 'rb') as f:
+          polygon = shapely.from_wkb(f.read())
+        with self.lock:
+          self.counters['disk_hits'] += 1
+        self._remember(key, fetched_at, polygon)
+        return polygon
+    except OSError:
+      pass
+    except Exception as e:
+      print(f"Ignoring unreadable cached polygon for {city}: {e}")
+    with self.lock:
+      self.counters['misses'] += 1
+    polygon = self.loader(city)
+    if polygon is None:
+      with self.lock:
+        self.counters['fetch_errors'] += 1
+      return None
+    self._remember(key, time.time(), polygon)
+    self._save(path, polygon)
+    return polygon
+
+  def _save(self, path, polygon):
+    try:
+      os.makedirs(self.directory, exist_ok=True)
+      # Write to a temporary file first so readers never see a half-written polygon
+      tmp_path = f'{path}.{threading.get_ident()}.tmp'
+      with open(tmp_path, 'wb') as f:
+        f.write(shapely.to_wkb(polygon))
+      os.replace(tmp_path, path)
+      files = [os.path.join(self.directory, name) for name in os.listdir(self.directory) if name.endswith('.wkb')]
+      if len(files) > self.max_files:
+        files.sort(key=os.path.getmtime)
+        for old_path in files[:len(files) - self.max_files]:
+          os.remove(old_path)
+    except OSError as e:
+      print(f"An error occurred while saving the polygon cache to {self.directory}: {e}")
+
+  def stats(self):
+    with self.lock:
+      # A request that waited on another fetch did not go to Nominatim, so it counts as a hit
+      hits = self.counters['memory_hits'] + self.counters['disk_hits'] + self.counters['waits']
+      lookups = hits + self.counters['misses']
+      return {
+        **self.counters,
+        'hit_ratio': round(hits / lookups, 4) if lookups else None,
+        'entries_in_memory': len(self.memory),
+        'in_flight': len(self.in_flight),
+      }
+
+polygon_cache = PolygonCache(
+  loader=lambda city: get_city_polygon(city),
+  directory=os.environ.get('POLYGON_CACHE_DIR', 'polygon_cache'),
+  ttl=float(os.environ.get('POLYGON_CACHE_TTL', 30 * 24 * 3600)),
+  max_entries=int(os.environ.get('POLYGON_CACHE_SIZE', 128)),
+  max_files=int(os.environ.get('POLYGON_CACHE_FILES', 10000)),
+)
+
+# Zoom level used in the generated Google Maps URLs
+DEFAULT_ZOOM = 15
+# Width in pixels of the map viewport we want each grid point to cover
+VIEWPORT_PX = 400
+# Web Mercator ground resolution at the equator for zoom 0, in meters per pixel
+EQUATOR_METERS_PER_PX = 156543.03392
+GRID_LAYOUTS = ('square', 'hexagonal')
+# Finer grids than this are far below what one viewport can tell apart and only multiply the URLs
+MIN_SPACING_M = 50
+# Largest lattice (cells in the bounding box, before clipping to the city) one request may build;
+# each of the coordinate arrays takes 8 bytes per cell
+MAX_GRID_CELLS = int(os.environ.get('MAX_GRID_CELLS', 10000000))
+
+class GridTooLargeError(ValueError):
+  pass
+
+def grid_spacing_for_zoom(zoom, latitude):
+  # Ground distance covered by one viewport at this zoom; Mercator shrinks it by cos(latitude)
+  return VIEWPORT_PX * EQUATOR_METERS_PER_PX * np.cos(np.radians(latitude)) / 2 ** zoom
+
+def project_to_local_metric(city_polygon):
+  # Azimuthal equidistant projection centred on the city, so distances near it are true meters
+  from pyproj import Transformer
+  center = city_polygon.centroid
+  local_crs = f'+proj=aeqd +lat_0={center.y} +lon_0={center.x} +datum=WGS84 +units=m'
+  to_local = Transformer.from_crs('EPSG:4326', local_crs, always_xy=True)
+  to_lonlat = Transformer.from_crs(local_crs, 'EPSG:4326', always_xy=True)
+  local_polygon = shapely.transform(city_polygon, lambda coords: np.column_stack(to_local.transform(coords[:, 0], coords[:, 1])))
+  return local_polygon, to_lonlat
+
+def lattice_step(spacing_m, layout):
+  # Returns the distance between neighbouring points on a row and between rows.
+  # A square grid with spacing s leaves no location further than s/sqrt(2) from a point.
+  # The hexagonal grid is scaled to keep that same worst case, which needs fewer points.
+  if layout == 'square':
+    return spacing_m, spacing_m
+  if layout == 'hexagonal':
+    step = spacing_m * np.sqrt(3 / 2)
+    return step, step * np.sqrt(3) / 2
+  raise ValueError(f"Unknown grid layout '{layout}', expected one of {', '.join(GRID_LAYOUTS)}.")
+
+def grid_cell_area(spacing_m, layout):
+  dx, dy = lattice_step(spacing_m, layout)
+  return dx * dy
+
+def create_grid(city_polygon, spacing_m=None, layout='square', zoom=DEFAULT_ZOOM):
   try:
     print("Generating the list of grid points for this city...")
-    minx, miny, maxx, maxy = city_polygon.bounds
-    # Number of grid points in x and y direction
-    nx = round((maxx - minx) * 69)  # number of points is distance (in degrees) times miles per degree
-    ny = round((maxy - miny) * 69)  # same for y direction
-    x_coords = np.linspace(minx, maxx, nx)
-    y_coords = np.linspace(miny, maxy, ny)
-    grid_points = []
-    for x in x_coords:
-      for y in y_coords:
-        point = Point(x, y)
-        if city_polygon.contains(point):
-          grid_points.append((x, y))
+    if spacing_m is None:
+      spacing_m = grid_spacing_for_zoom(zoom, city_polygon.centroid.y)
+    dx, dy = lattice_step(spacing_m, layout)
+    local_polygon, to_lonlat = project_to_local_metric(city_polygon)
+    minx, miny, maxx, maxy = local_polygon.bounds
+    # Centre the lattice on the bounding box so the margins are even on both sides
+    nx = int((maxx - minx) // dx) + 1
+    ny = int((maxy - miny) // dy) + 1
+    if nx * ny > MAX_GRID_CELLS:
+      raise GridTooLargeError(f"A {spacing_m:g} m grid over this city needs {nx * ny} cells, more than the limit of {MAX_GRID_CELLS}; use a larger spacing_m.")
+    x_coords = minx + ((maxx - minx) - (nx - 1) * dx) / 2 + np.arange(nx) * dx
+    y_coords = miny + ((maxy - miny) - (ny - 1) * dy) / 2 + np.arange(ny) * dy
+    # Build the whole mesh at once, x-major to match the order of the old nested loop
+    xx, yy = np.meshgrid(x_coords, y_coords, indexing='ij')
+    if layout == 'hexagonal':
+      # Every other row is shifted by half a step
+      xx = xx + (np.arange(ny) % 2) * dx / 2
+    xx = xx.ravel()
+    yy = yy.ravel()
+    # Preparing the polygon builds its spatial index once for the bulk containment test
+    shapely.prepare(local_polygon)
+    inside = shapely.contains_xy(local_polygon, xx, yy)
+    if not inside.any():
+      # Adapt to places smaller than one cell: keep a single point inside the polygon
+      point = local_polygon.representative_point()
+      xx, yy, inside = np.array([point.x]), np.array([point.y]), np.array([True])
+    lon, lat = to_lonlat.transform(xx[inside], yy[inside])
+    grid_points = np.column_stack((lon, lat))
     print(f"Successfully generated {len(grid_points)} grid points.")
     return grid_points
+  except GridTooLargeError:
+    raise
   except Exception as e:
     print(f"An error occurred while creating the grid in the city: {e}")
-    return []
+    return np.empty((0, 2))
 
-def plot_grid_points(grid_points):  # add ', filename' after 'grid_points' when testing file writing
-    if grid_points:
-        # Create a folium map centered at the first grid point
-        folium_map = folium.Map(location=[grid_points[0][1], grid_points[0][0]], zoom_start=13)
+def grid_coverage_ratio(city_polygon, number_of_points, spacing_m=None, layout='square', zoom=DEFAULT_ZOOM):
+  # Area represented by the grid points divided by the city area; close to 1 means no over- or undersampling
+  if spacing_m is None:
+    spacing_m = grid_spacing_for_zoom(zoom, city_polygon.centroid.y)
+  local_polygon, _ = project_to_local_metric(city_polygon)
+  if local_polygon.area == 0:
+    return None
+  return round(float(number_of_points * grid_cell_area(spacing_m, layout) / local_polygon.area), 4)
+
+def create_grid_from_wkb(polygon_wkb, spacing_m=None, layout='square', zoom=DEFAULT_ZOOM):
+  # Runs in a worker process; the polygon is passed as WKB, which is compact and quick to send between processes
+  start = time.perf_counter()
+  city_polygon = shapely.from_wkb(polygon_wkb)
+  grid_points = create_grid(city_polygon, spacing_m, layout, zoom)
+  # A valid polygon always yields at least one point, so an empty grid means the build failed
+  if not len(grid_points):
+    raise Exception("Could not build the grid.")
+  coverage_ratio = grid_coverage_ratio(city_polygon, len(grid_points), spacing_m, layout, zoom)
+  return grid_points, coverage_ratio, time.perf_counter() - start
 
-        # Create a marker cluster
-        marker_cluster = MarkerCluster().add_to(folium_map)
+def create_grids(city_polygons, spacing_m=None, layout='square', zoom=DEFAULT_ZOOM, workers=None):
+  # Builds the grids for a {key: polygon} dict across worker processes.
+  # Returns {key: (grid_points, coverage_ratio, seconds)}, or the exception raised for that key.
+  workers = workers or os.cpu_count() or 1
+  results = {}
+  if workers == 1:
+    for key, city_polygon in city_polygons.items():
+      try:
+        results[key] = create_grid_from_wkb(shapely.to_wkb(city_polygon), spacing_m, layout, zoom)
+      except Exception as e:
+        results[key] = e
+    return results
+  # Forking a multithreaded server can copy a lock another thread holds (print's, the caches') into the
+  # child, where nothing will ever release it, so the workers are started fresh instead
+  with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+    futures = {key: pool.submit(create_grid_from_wkb, shapely.to_wkb(city_polygon), spacing_m, layout, zoom)
+               for key, city_polygon in city_polygons.items()}
+    for key, future in futures.items():
+      try:
+        results[key] = future.result()
+      except Exception as e:
+        results[key] = e
+  return results
 
-        # Add all grid points to the map within the marker cluster
-        for i, point in enumerate(grid_points):
-            folium.CircleMarker([point[1], point[0]], radius=1, color="red").add_to(marker_cluster)
-            if i % 100 == 0:  # log every 100 points
-                print(f"Plotted {i} points so far.")
+# Draws each clustered point as a small red circle, like the per-point CircleMarkers used to
+GRID_POINT_CALLBACK = """function (row) {
+  return L.circleMarker(new L.LatLng(row[0], row[1]), {radius: 1, color: 'red'});
+}"""
 
-        # Save the map to an HTML file
-        # Uncomment the next line when testing file writing. Make sure to pass 'filename' as an argument to this function.
-        # folium_map.save(filename + '.html')
-        print(f"Successfully plotted all {len(grid_points)} points.")
+def plot_grid_points(grid_points):
+    # Returns a folium map of the grid. All points go into one FastMarkerCluster data array instead of
+    # one marker object per point, so building and rendering the map stays fast for large grids.
+    if not len(grid_points):
+        return None
+    import folium
+    from folium.plugins import FastMarkerCluster
+    minx, miny = grid_points.min(axis=0)
+    maxx, maxy = grid_points.max(axis=0)
+    folium_map = folium.Map(location=[(miny + maxy) / 2, (minx + maxx) / 2], zoom_start=13)
+    FastMarkerCluster(grid_points[:, ::-1].tolist(), callback=GRID_POINT_CALLBACK).add_to(folium_map)
+    folium_map.fit_bounds([[miny, minx], [maxy, maxx]])
+    print(f"Successfully plotted all {len(grid_points)} points.")
+    return folium_map
 
-def generate_google_maps_url(city_name, location_of_interest, point):
+def generate_google_maps_url(city_name, location_of_interest, point, zoom=DEFAULT_ZOOM):
   # Order of coordinates is important for Google Maps
   longitude, latitude = point
   
-  # https://www.google.com/maps/search/{keyword}/@{LAT},{LONG},15z
-  google_maps_url = f'https://www.google.com/maps/search/{location_of_interest}/@{latitude},{longitude},15z'
+  # https://www.google.com/maps/search/{keyword}/@{LAT},{LONG},{ZOOM}z
+  google_maps_url = f'https://www.google.com/maps/search/{location_of_interest}/@{latitude},{longitude},{zoom}z'
   
   return google_maps_url
 
@@ -96,15 +413,86 @@ def write_urls_to_file(urls, filename):
   except Exception as e:
     print(f"An error occurred while writing URLs to the file: {e}")
   
+# Grid points are stored as packed little-endian float64 (lon, lat) pairs, 16 bytes per point.
+# 100k points per chunk keeps each document around 1.6 MB, well below Mongo's 16 MB limit.
+POINTS_PER_CHUNK = 100000
+METADATA_ID = 'metadata'
+
+def pack_points(grid_points):
+  from bson.binary import Binary
+  return Binary(np.ascontiguousarray(grid_points, dtype='<f8').tobytes())
+
+def unpack_points(packed):
+  return np.frombuffer(packed, dtype='<f8').reshape(-1, 2)
+
+def save_grid(collection, grid_points, metadata):
+  # Clear the old grid (and any documents from the old one-per-URL layout), bulk insert the point chunks,
+  # then write the metadata document last so readers never see a half-written grid
+  number_of_chunks = max(1, -(-len(grid_points) // POINTS_PER_CHUNK))
+  with timed('db_write'):
+    collection.delete_many({})
+    collection.insert_many([
+      {'_id': f'points-{i}', 'chunk': i, 'points': pack_points(grid_points[i * POINTS_PER_CHUNK:(i + 1) * POINTS_PER_CHUNK])}
+      for i in range(number_of_chunks)
+    ], ordered=False)
+    metadata = {**metadata, 'number_of_points': len(grid_points), 'chunks': number_of_chunks, 'points_per_chunk': POINTS_PER_CHUNK}
+    collection.insert_one({'_id': METADATA_ID, **metadata})
+  return metadata
+
+def load_metadata(collection):
+  with timed('db_read'):
+    metadata = collection.find_one({'_id': METADATA_ID}, {'_id': 0})
+  if metadata is not None and not metadata['number_of_points']:
+    # Only a failed build leaves an empty grid behind; treat it as missing so it is rebuilt
+    return None
+  return metadata
+
+def load_grid_points(collection, metadata, start=0, end=None):
+  # Returns points [start, end) of the stored grid, reading only the chunks that hold them
+  end = metadata['number_of_points'] if end is None else min(end, metadata['number_of_points'])
+  if start >= end:
+    return np.empty((0, 2))
+  points_per_chunk = metadata.get('points_per_chunk', POINTS_PER_CHUNK)
+  first_chunk, last_chunk = start // points_per_chunk, (end - 1) // points_per_chunk
+  chunk_ids = [f'points-{i}' for i in range(first_chunk, last_chunk + 1)]
+  with timed('db_read'):
+    chunks = {doc['chunk']: unpack_points(doc['points']) for doc in collection.find({'_id': {'$in': chunk_ids}}, {'chunk': 1, 'points': 1})}
+  if len(chunks) != len(chunk_ids):
+    raise Exception(f"Stored grid is incomplete: found {len(chunks)} of {len(chunk_ids)} chunks.")
+  grid_points = np.concatenate([chunks[i] for i in range(first_chunk, last_chunk + 1)])
+  offset = first_chunk * points_per_chunk
+  return grid_points[start - offset:end - offset]
+
 app = Flask(__name__)
 
-mongo_uri = os.environ.get('MONGO_URI')
-if mongo_uri is None:
-    print("Please set the MONGO_URI environment variable.")
-    exit(1)
+mongo = None
+mongo_lock = threading.Lock()
 
-app.config["MONGO_URI"] = mongo_uri
-mongo = PyMongo(app)
+def get_mongo():
+    # Connect on first use rather than at import time
+    global mongo
+    with mongo_lock:
+        if mongo is None:
+            mongo_uri = os.environ.get('MONGO_URI')
+            if mongo_uri is None:
+                raise Exception("Please set the MONGO_URI environment variable.")
+            from flask_pymongo import PyMongo
+            app.config["MONGO_URI"] = mongo_uri
+            mongo = PyMongo(app)
+        return mongo
+
+def grid_options_error(spacing_m, layout, zoom):
+    # Returns a message describing the first invalid grid option, or None
+    if layout not in GRID_LAYOUTS:
+        return f"layout must be one of {', '.join(GRID_LAYOUTS)}"
+    # bool is a subclass of int, so true and false have to be ruled out explicitly.
+    # Flask's JSON parser also accepts NaN and Infinity, which no comparison below would catch.
+    if spacing_m is not None and (isinstance(spacing_m, bool) or not isinstance(spacing_m, (int, float))
+                                  or not math.isfinite(spacing_m) or spacing_m < MIN_SPACING_M):
+        return f'spacing_m must be a number of meters no smaller than {MIN_SPACING_M}'
+    if isinstance(zoom, bool) or not isinstance(zoom, int) or not 0 <= zoom <= 21:
+        return 'zoom must be an integer between 0 and 21'
+    return None
 
 @app.route('/generate/urls', methods=['POST'])
 def generate_urls():
@@ -112,64 +500,634 @@ def generate_urls():
         data = request.get_json()
         city_name = data['city_name']
         location_of_interest = data['location_of_interest']
-        return process_generate_urls(city_name, location_of_interest)
+        spacing_m = data.get('spacing_m')
+        layout = data.get('layout', 'square')
+        zoom = data.get('zoom', DEFAULT_ZOOM)
+        error = grid_options_error(spacing_m, layout, zoom)
+        if error:
+            return jsonify({'error': 'Bad request', 'message': error}), 400
+        output_format = data.get('format', 'json')
+        if output_format not in OUTPUT_FORMATS:
+            return jsonify({'error': 'Bad request', 'message': f"format must be one of {', '.join(OUTPUT_FORMATS)}"}), 400
+        limit = data.get('limit')
+        if limit is not None and (isinstance(limit, bool) or not isinstance(limit, int) or limit <= 0):
+            return jsonify({'error': 'Bad request', 'message': 'limit must be a positive integer'}), 400
+        cursor = data.get('cursor')
+        if cursor is not None:
+            cursor = decode_cursor(cursor)
+            if cursor is None:
+                return jsonify({'error': 'Bad request', 'message': 'cursor is not valid'}), 400
+        wait = data.get('wait', False)
+        if not isinstance(wait, bool):
+            return jsonify({'error': 'Bad request', 'message': 'wait must be true or false'}), 400
+        return process_generate_urls(city_name, location_of_interest, spacing_m, layout, zoom, limit, cursor, output_format, wait)
     except Exception as e:
         return jsonify({'error': 'Internal server error', 'message': str(e)}), 500
 
-def process_generate_urls(city_name, location_of_interest):
+@app.route('/cache/polygons', methods=['GET'])
+def polygon_cache_stats():
+    return jsonify(polygon_cache.stats()), 200
+
+def grid_name(spacing_m=None, layout='square', zoom=DEFAULT_ZOOM):
+    # Different grid settings produce different points, so each gets its own stored grid
+    if spacing_m is None:
+        spacing = 'auto'
+    else:
+        # 1000 and 1000.0 must name the same grid, whether they came from JSON, a query string or the CLI
+        spacing = f"{int(spacing_m) if float(spacing_m).is_integer() else spacing_m}m"
+    return f"{layout}_{spacing}_{zoom}z"
+
+def grid_collection(city_name, spacing_m=None, layout='square', zoom=DEFAULT_ZOOM):
+    db = get_mongo().db
+    if db is None:
+        raise Exception("Database is not initialized.")
+    # One grid per city and grid settings, shared by every keyword
+    city_slug = PolygonCache.key(city_name).replace(' ', '_')
+    return db[f"grid_{city_slug}_{grid_name(spacing_m, layout, zoom)}"]
+
+def get_grid(city_name, spacing_m=None, layout='square', zoom=DEFAULT_ZOOM, progress=None):
+    # Returns (metadata, grid_points, previously_existed), building and saving the grid on first use.
+    # progress, if given, is called with the name of each stage as the grid is built.
+    progress = progress or (lambda stage: None)
+    collection = grid_collection(city_name, spacing_m, layout, zoom)
+    # Both lookups go through the _id index and only fetch the fields they need
+    metadata = load_metadata(collection)
+    if metadata is not None:
+        print(f"Retrieving existing grid for {city_name}...")
+        return metadata, load_grid_points(collection, metadata), True
+    progress('fetching polygon')
+    with timed('polygon_fetch'):
+        city_polygon = polygon_cache.get(city_name)
+    if city_polygon is None:
+        raise Exception(f"Could not find the boundary of {city_name}.")
+    progress('building grid')
+    with timed('grid'):
+        grid_points = create_grid(city_polygon, spacing_m, layout, zoom)
+        # A valid polygon always yields at least one point, so an empty grid means the build failed
+        if not len(grid_points):
+            raise Exception(f"Could not build the grid for {city_name}.")
+        coverage_ratio = grid_coverage_ratio(city_polygon, len(grid_points), spacing_m, layout, zoom)
+    progress('saving grid')
+    metadata = save_grid(collection, grid_points, {
+        'city': city_name,
+        'layout': layout,
+        'spacing_m': spacing_m,
+        'zoom': zoom,
+        'coverage_ratio': coverage_ratio,
+        'generation_time': datetime.now().isoformat(),  # Record the current time as the generation time
+    })
+    return metadata, grid_points, False
+
+# Grids that are not stored yet are built by a pool of background workers
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 4))
+# Finished jobs are forgotten after this many seconds
+JOB_TTL = float(os.environ.get('JOB_TTL', 3600))
+JOB_STAGES = ('queued', 'fetching polygon', 'building grid', 'saving grid', 'done')
+job_executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix='grid-job')
+jobs = {}  # job id -> job dict
+jobs_by_grid = {}  # grid collection name -> id of the job building it
+jobs_lock = threading.Lock()
+
+def job_status(job):
+    # The job as returned by the API, without the internal bookkeeping
+    status = {key: value for key, value in job.items() if key not in ('future', 'finished_at', 'exception')}
+    status['timings'] = rounded_timings(dict(job['timings']))
+    return status
+
+def update_job(job, **fields):
+    with jobs_lock:
+        job.update(fields)
+        if 'stage' in fields:
+            job['progress'] = round(JOB_STAGES.index(fields['stage']) / (len(JOB_STAGES) - 1), 2)
+
+def new_job(**fields):
+    # A job dict in its initial state; future is resolved once the job has finished, whatever the outcome
+    return {
+        'job_id': uuid.uuid4().hex,
+        **fields,
+        'status': 'queued',
+        'stage': 'queued',
+        'progress': 0.0,
+        'result': None,
+        'error': None,
+        'timings': {},
+        'created': datetime.now().isoformat(),
+        'finished': None,
+        'finished_at': None,
+        'future': Future(),
+    }
+
+def forget_old_jobs():
+    # Callers hold jobs_lock
+    now = time.time()
+    for job_id in [job_id for job_id, job in jobs.items() if job['finished_at'] and now - job['finished_at'] > JOB_TTL]:
+        del jobs[job_id]
+
+def finish_job(job, result=None, error=None, grid_key=None):
+    finished = {'finished': datetime.now().isoformat(), 'finished_at': time.time()}
+    if error is None:
+        update_job(job, status='done', stage='done', result=result, **finished)
+    else:
+        update_job(job, status='failed', error=str(error), exception=error, **finished)
+    if grid_key is not None:
+        with jobs_lock:
+            if jobs_by_grid.get(grid_key) == job['job_id']:
+                del jobs_by_grid[grid_key]
+    job['future'].set_result(None)
+
+def claim_grid_job(grid_key, city_name, spacing_m, layout, zoom):
+    # Returns (job, created). Whoever gets created=True must build the grid and finish the job;
+    # everyone else joins the job already in flight.
+    with jobs_lock:
+        forget_old_jobs()
+        job_id = jobs_by_grid.get(grid_key)
+        if job_id is not None:
+            return jobs[job_id], False
+        job = new_job(kind='grid', city=city_name, layout=layout, spacing_m=spacing_m, zoom=zoom)
+        jobs[job['job_id']] = job
+        jobs_by_grid[grid_key] = job['job_id']
+        return job, True
+
+def run_grid_job(job, grid_key, city_name, spacing_m, layout, zoom):
+    update_job(job, status='running')
+    try:
+        with recording_timings(job['timings']):
+            metadata, _, _ = get_grid(city_name, spacing_m, layout, zoom, progress=lambda stage: update_job(job, stage=stage))
+        finish_job(job, result=metadata, grid_key=grid_key)
+    except Exception as e:
+        print(f"Job {job['job_id']} for {city_name} failed: {e}")
+        finish_job(job, error=e, grid_key=grid_key)
+
+def submit_grid_job(city_name, spacing_m=None, layout='square', zoom=DEFAULT_ZOOM):
+    # Returns the job building this grid, joining the one already in flight if there is one
+    grid_key = grid_collection(city_name, spacing_m, layout, zoom).name
+    job, created = claim_grid_job(grid_key, city_name, spacing_m, layout, zoom)
+    if created:
+        job_executor.submit(run_grid_job, job, grid_key, city_name, spacing_m, layout, zoom)
+    return job
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    with stage_metrics_lock:
+        stages = {
+            stage: {
+                'count': metric['count'],
+                'total_s': round(metric['total_s'], 4),
+                'mean_s': round(metric['total_s'] / metric['count'], 4),
+                'max_s': round(metric['max_s'], 4),
+            }
+            for stage, metric in stage_metrics.items()
+        }
+    with jobs_lock:
+        job_counts = {}
+        for job in jobs.values():
+            job_counts[job['status']] = job_counts.get(job['status'], 0) + 1
+    return jsonify({'stages': stages, 'polygon_cache': polygon_cache.stats(), 'jobs': job_counts}), 200
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    with jobs_lock:
+        job = jobs.get(job_id)
+        if job is None:
+            return jsonify({'error': 'Not found', 'message': f"No job with id {job_id}"}), 404
+        return jsonify(job_status(job)), 200
+
+# Rendered maps are kept here, one HTML file per stored grid version
+MAP_CACHE_DIR = os.environ.get('MAP_CACHE_DIR', 'map_cache')
+
+def map_cache_path(grid_key, generation_time):
+    # The generation time is part of the name, so a regenerated grid never serves a stale map
+    version = hashlib.sha1(generation_time.encode('utf-8')).hexdigest()[:12]
+    return os.path.join(MAP_CACHE_DIR, f"{grid_key}.{version}.html")
+
+def get_grid_map(city_name, spacing_m=None, layout='square', zoom=DEFAULT_ZOOM):
+    # Returns the map HTML for a stored grid, rendering it only if this grid version has not been rendered yet.
+    # Returns None if the grid has not been generated.
+    collection = grid_collection(city_name, spacing_m, layout, zoom)
+    metadata = load_metadata(collection)
+    if metadata is None:
+        return None
+    path = map_cache_path(collection.name, metadata['generation_time'])
+    try:
+        with open(path, encoding='utf-8') as f:
+            return f.read()
+    except OSError:
+        pass
+    print(f"Rendering map for {city_name}...")
+    grid_points = load_grid_points(collection, metadata)
+    with timed('map_render'):
+        folium_map = plot_grid_points(grid_points)
+        html = folium_map.get_root().render() if folium_map is not None else '<p>This grid has no points.</p>'
     try:
-        db = mongo.db  
-        if db is None:
-            raise Exception("Database is not initialized.")
-
-        # Dynamically set the database and collection
-        db_name = f"{location_of_interest}_urls"
-        coll_name = f"{location_of_interest}_{city_name.replace(' ', '_')}_urls"
-        db = mongo.cx[db_name]  
-        urls_collection = db[coll_name]  
-
-        urls_exist = False
-        generation_time = None
-        # Check if collection exists and contains data
-        if urls_collection.count_documents({}) > 0:
-            # Check if any URL document has a "generation_time" field
-            if urls_collection.count_documents({'generation_time': {'$exists': True}}) > 0:
-                print(f"Retrieving existing URLs for {city_name} and {location_of_interest}...")
-                urls_exist = True
-                urls = [doc['url'] for doc in urls_collection.find()]
-                # Retrieve the generation time from one of the URL documents
-                doc = urls_collection.find_one({'generation_time': {'$exists': True}})
-                if doc:
-                    generation_time = doc['generation_time']
+        os.makedirs(MAP_CACHE_DIR, exist_ok=True)
+        # Drop maps of older versions of this grid before saving the new one
+        for name in os.listdir(MAP_CACHE_DIR):
+            if name.startswith(f"{collection.name}.") and name.endswith('.html'):
+                os.remove(os.path.join(MAP_CACHE_DIR, name))
+        tmp_path = f'{path}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(html)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"An error occurred while saving the map to {MAP_CACHE_DIR}: {e}")
+    return html
+
+def query_number(name, cast, default=None):
+    # Unlike request.args.get(type=...), which silently falls back to the default, an unparseable value is
+    # returned as the raw string so grid_options_error rejects it instead of another grid being served
+    value = request.args.get(name)
+    if value is None:
+        return default
+    try:
+        return cast(value)
+    except ValueError:
+        return value
+
+@app.route('/map', methods=['GET'])
+def grid_map():
+    try:
+        city_name = request.args.get('city')
+        if not city_name:
+            return jsonify({'error': 'Bad request', 'message': 'city is required'}), 400
+        spacing_m = query_number('spacing_m', float)
+        layout = request.args.get('layout', 'square')
+        zoom = query_number('zoom', int, DEFAULT_ZOOM)
+        error = grid_options_error(spacing_m, layout, zoom)
+        if error:
+            return jsonify({'error': 'Bad request', 'message': error}), 400
+        html = get_grid_map(city_name, spacing_m, layout, zoom)
+        if html is None:
+            return jsonify({'error': 'Not found', 'message': f"No URLs have been generated for {city_name} with these grid settings yet."}), 404
+        return Response(html, mimetype='text/html'), 200
+    except Exception as e:
+        return jsonify({'error': 'Internal server error', 'message': str(e)}), 500
+
+OUTPUT_FORMATS = ('json', 'ndjson', 'csv')
+# Number of URLs rendered and written per piece of a streamed response
+STREAM_BATCH_SIZE = 1000
+
+def encode_cursor(generation_time, offset):
+    # The generation time ties the cursor to one version of the grid, so a regenerated grid is not paged inconsistently
+    return base64.urlsafe_b64encode(json.dumps([generation_time, offset]).encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor):
+    # Returns (generation_time, offset), or None if the cursor was not made by encode_cursor
+    try:
+        generation_time, offset = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        if isinstance(generation_time, str) and isinstance(offset, int) and not isinstance(offset, bool) and offset >= 0:
+            return generation_time, offset
+    except Exception:
+        pass
+    return None
+
+def stream_urls(city_name, location_of_interest, grid_points, zoom, output_format):
+    # Renders the URLs a batch at a time straight from the grid array, so the full list never exists in memory
+    if output_format == 'csv':
+        yield 'url,latitude,longitude\r\n'
+    for start in range(0, len(grid_points), STREAM_BATCH_SIZE):
+        # Plain Python floats format several times faster than NumPy scalars
+        batch = grid_points[start:start + STREAM_BATCH_SIZE].tolist()
+        if output_format == 'csv':
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            writer.writerows((generate_google_maps_url(city_name, location_of_interest, point, zoom), point[1], point[0]) for point in batch)
+            yield buffer.getvalue()
+        else:
+            yield ''.join('{"url": %s}\n' % json.dumps(generate_google_maps_url(city_name, location_of_interest, point, zoom)) for point in batch)
+
+def process_generate_urls(city_name, location_of_interest, spacing_m=None, layout='square', zoom=DEFAULT_ZOOM,
+                          limit=None, cursor=None, output_format='json', wait=False):
+    start = time.perf_counter()
+    # Every timed stage below adds itself to this request's timings
+    with recording_timings({}) as timings:
+        try:
+            collection = grid_collection(city_name, spacing_m, layout, zoom)
+            # One indexed read tells whether the grid is stored and, if it is, how to load it
+            metadata = load_metadata(collection)
+            urls_exist = metadata is not None
+            if metadata is None:
+                # Building a new grid takes a while, so it runs as a background job the client can poll
+                job = submit_grid_job(city_name, spacing_m, layout, zoom)
+                if not wait:
+                    return jsonify({
+                        'message': 'URLs are being generated, poll the job for progress and repeat this request when it is done',
+                        'job_id': job['job_id'],
+                        'status': job['status'],
+                        'status_url': f"/jobs/{job['job_id']}",
+                    }), 202
+                job['future'].result()
+                if job['status'] == 'failed':
+                    if isinstance(job.get('exception'), GridTooLargeError):
+                        return jsonify({'error': 'Bad request', 'message': job['error']}), 400
+                    raise Exception(job['error'])
+                metadata = job['result']
+                for stage, seconds in job['timings'].items():
+                    timings[stage] = timings.get(stage, 0.0) + seconds
+
+            # Page through the grid; without a limit the whole grid is returned as before
+            number_of_points = metadata['number_of_points']
+            offset = 0
+            if cursor is not None:
+                cursor_generation_time, offset = cursor
+                if cursor_generation_time != metadata['generation_time']:
+                    return jsonify({'error': 'Bad request', 'message': 'cursor has expired because the grid was regenerated'}), 400
+            end = number_of_points if limit is None else min(offset + limit, number_of_points)
+            page_points = load_grid_points(collection, metadata, offset, end)
+            next_cursor = encode_cursor(metadata['generation_time'], end) if end < number_of_points else None
+
+            if output_format != 'json':
+                # Streamed responses carry the summary in headers since the body is just the URLs
+                headers = {
+                    'X-Number-Of-Points': str(metadata['number_of_points']),
+                    'X-Generation-Time': metadata['generation_time'],
+                    'X-URLs-Previously-Existed': str(urls_exist).lower(),
+                }
+                if metadata['coverage_ratio'] is not None:
+                    headers['X-Coverage-Ratio'] = str(metadata['coverage_ratio'])
+                if next_cursor is not None:
+                    headers['X-Next-Cursor'] = next_cursor
+                # URL rendering happens while the body streams, so it is not part of these timings
+                headers['X-Timings'] = json.dumps(rounded_timings({**timings, 'total': time.perf_counter() - start}))
+                mimetype = 'text/csv' if output_format == 'csv' else 'application/x-ndjson'
+                return Response(stream_urls(city_name, location_of_interest, page_points, zoom, output_format),
+                                mimetype=mimetype, headers=headers), 200
+
+            # The keyword is only substituted into the URL, so URLs are rendered per request from the shared grid
+            with timed('url_render'):
+                urls = [generate_google_maps_url(city_name, location_of_interest, point, zoom) for point in page_points.tolist()]
+
+            return jsonify({
+                'message': 'URLs retrieved or generated successfully', 
+                'city': city_name,
+                'location_of_interest': location_of_interest,
+                'number_of_urls': len(urls),
+                'number_of_points': metadata['number_of_points'],
+                'layout': layout,
+                'spacing_m': spacing_m,
+                'zoom': zoom,
+                'coverage_ratio': metadata['coverage_ratio'],
+                'urls_previously_existed': urls_exist,
+                'generation_time': metadata['generation_time'],
+                'next_cursor': next_cursor,
+                'timings': rounded_timings({**timings, 'total': time.perf_counter() - start}),
+                'urls': urls
+            }), 200
+        except Exception as e:
+            return jsonify({'error': 'Internal server error', 'message': str(e)}), 500
+
+# Number of processes building grids in a batch, defaults to one per core
+BATCH_WORKERS = int(os.environ.get('BATCH_WORKERS', 0)) or None
+
+def process_batch(city_names, keywords, spacing_m=None, layout='square', zoom=DEFAULT_ZOOM, workers=BATCH_WORKERS, progress=None):
+    # Makes sure every city has a stored grid and reports the status and timings of each (city, keyword) pair.
+    # Each city is geocoded and built once however many keywords it has, and grids are built in parallel.
+    # Every build is registered as a grid job, so a batch and /generate/urls never build the same grid at once.
+    progress = progress or (lambda stage: None)
+    cities = OrderedDict()
+    for city_name in city_names:
+        cities.setdefault(PolygonCache.key(city_name), {'city': city_name, 'status': None, 'error': None, 'timings': {}})
+    # Keys of the cities whose grid job this batch claimed and therefore has to finish
+    owned = []
+
+    def fail(key, error):
+        cities[key].update(status='failed', error=str(error))
+        finish_job(cities[key]['job'], error=error, grid_key=cities[key]['collection'].name)
+
+    def fetch_polygon(key):
+        with recording_timings(cities[key]['timings']), timed('polygon_fetch'):
+            return key, polygon_cache.get(cities[key]['city'])
+
+    try:
+        # Per-city timings use the same stage names as /generate/urls and /metrics
+        for key, city in cities.items():
+            city['collection'] = grid_collection(city['city'], spacing_m, layout, zoom)
+            with recording_timings(city['timings']):
+                metadata = load_metadata(city['collection'])
+            if metadata is not None:
+                city.update(status='stored', metadata=metadata)
+                continue
+            city['job'], owns_job = claim_grid_job(city['collection'].name, city['city'], spacing_m, layout, zoom)
+            if owns_job:
+                owned.append(key)
+
+        progress('fetching polygon')
+        for key in owned:
+            update_job(cities[key]['job'], status='running', stage='fetching polygon')
+        city_polygons = {}
+        # Nominatim allows few concurrent requests, so there is no point in more threads than that
+        with ThreadPoolExecutor(max_workers=NOMINATIM_CONCURRENCY) as pool:
+            for key, city_polygon in pool.map(fetch_polygon, owned):
+                if city_polygon is None:
+                    fail(key, Exception(f"Could not find the boundary of {cities[key]['city']}."))
+                else:
+                    city_polygons[key] = city_polygon
+                    update_job(cities[key]['job'], stage='building grid')
+
+        progress('building grid')
+        grids = create_grids(city_polygons, spacing_m, layout, zoom, workers)
+        progress('saving grid')
+        for key, result in grids.items():
+            city = cities[key]
+            if isinstance(result, Exception):
+                fail(key, Exception(f"Could not build the grid for {city['city']}: {result}"))
+                continue
+            grid_points, coverage_ratio, grid_seconds = result
+            update_job(city['job'], stage='saving grid')
+            try:
+                with recording_timings(city['timings']):
+                    # Grids are built in worker processes, so their time is recorded here on their behalf
+                    record_stage('grid', grid_seconds)
+                    metadata = save_grid(city['collection'], grid_points, {
+                        'city': city['city'],
+                        'layout': layout,
+                        'spacing_m': spacing_m,
+                        'zoom': zoom,
+                        'coverage_ratio': coverage_ratio,
+                        'generation_time': datetime.now().isoformat(),
+                    })
+                city.update(status='generated', metadata=metadata)
+                finish_job(city['job'], result=metadata, grid_key=city['collection'].name)
+            except Exception as e:
+                fail(key, e)
+    finally:
+        # Never leave a claimed job unfinished, or requests joining it would wait forever
+        for key in owned:
+            if not cities[key]['job']['future'].done():
+                fail(key, Exception("The batch stopped before this grid was built."))
+
+    # Grids another job was already building are waited for rather than built twice
+    for city in cities.values():
+        if city['status'] is None:
+            job = city['job']
+            job['future'].result()
+            if job['status'] == 'done':
+                city.update(status='generated', metadata=job['result'])
             else:
-                print(f"No existing URLs with 'generation_time' found for {city_name} and {location_of_interest}, generating new ones...")
-        if not urls_exist:
-            # Generate new URLs if they don't exist or don't have a "generation_time"
-            # urls_filename = f"urls_{city_name.replace(' ', '_')}_{location_of_interest.replace(' ', '_')}.txt"
-            # map_filename = f"map_{city_name.replace(' ', '_')}_{location_of_interest.replace(' ', '_')}"
-            city_polygon = get_city_polygon(city_name)
-            grid_points = create_grid(city_polygon)
-            plot_grid_points(grid_points)  # add ', map_filename' after 'grid_points' when testing file writing
-            urls = [generate_google_maps_url(city_name, location_of_interest, point) for point in grid_points]
-            # write_urls_to_file(urls, urls_filename)
-
-            # Save URLs to MongoDB
-            generation_time = datetime.now().isoformat()  # Record the current time as the generation time
-            for url in urls:
-                urls_collection.insert_one({'url': url, 'generation_time': generation_time})
+                city.update(status='failed', error=job['error'])
+
+    items = []
+    for city in cities.values():
+        metadata = city.get('metadata', {})
+        for location_of_interest in dict.fromkeys(keywords):
+            items.append({
+                'city': city['city'],
+                'location_of_interest': location_of_interest,
+                'status': city['status'],
+                'error': city['error'],
+                'number_of_urls': metadata.get('number_of_points', 0),
+                'coverage_ratio': metadata.get('coverage_ratio'),
+                'generation_time': metadata.get('generation_time'),
+                'timings': rounded_timings(city['timings']),
+            })
+    return items
 
+# Batches run on their own pool: they wait on grid jobs, so sharing job_executor could deadlock it
+BATCH_JOBS = int(os.environ.get('BATCH_JOBS', 1))
+batch_executor = ThreadPoolExecutor(max_workers=BATCH_JOBS, thread_name_prefix='batch-job')
+
+def run_batch_job(job, city_names, keywords, spacing_m, layout, zoom):
+    update_job(job, status='running')
+    try:
+        # Timings are recorded per city, in the items
+        items = process_batch(city_names, keywords, spacing_m, layout, zoom, progress=lambda stage: update_job(job, stage=stage))
+        finish_job(job, result={
+            'number_of_items': len(items),
+            'number_of_failures': sum(item['status'] == 'failed' for item in items),
+            'items': items,
+        })
+    except Exception as e:
+        print(f"Batch job {job['job_id']} failed: {e}")
+        finish_job(job, error=e)
+
+def submit_batch_job(city_names, keywords, spacing_m=None, layout='square', zoom=DEFAULT_ZOOM):
+    job = new_job(kind='batch', cities=city_names, keywords=keywords, layout=layout, spacing_m=spacing_m, zoom=zoom)
+    with jobs_lock:
+        forget_old_jobs()
+        jobs[job['job_id']] = job
+    batch_executor.submit(run_batch_job, job, city_names, keywords, spacing_m, layout, zoom)
+    return job
+
+@app.route('/generate/batch', methods=['POST'])
+def generate_batch():
+    try:
+        data = request.get_json()
+        city_names = data['cities']
+        keywords = data['keywords']
+        if not isinstance(city_names, list) or not all(isinstance(city, str) for city in city_names):
+            return jsonify({'error': 'Bad request', 'message': 'cities must be a list of city names'}), 400
+        if not isinstance(keywords, list) or not all(isinstance(keyword, str) for keyword in keywords):
+            return jsonify({'error': 'Bad request', 'message': 'keywords must be a list of strings'}), 400
+        spacing_m = data.get('spacing_m')
+        layout = data.get('layout', 'square')
+        zoom = data.get('zoom', DEFAULT_ZOOM)
+        error = grid_options_error(spacing_m, layout, zoom)
+        if error:
+            return jsonify({'error': 'Bad request', 'message': error}), 400
+        wait = data.get('wait', False)
+        if not isinstance(wait, bool):
+            return jsonify({'error': 'Bad request', 'message': 'wait must be true or false'}), 400
+        # Hundreds of cities at one Nominatim request per second take minutes, so batches run as jobs
+        start = time.perf_counter()
+        job = submit_batch_job(city_names, keywords, spacing_m, layout, zoom)
+        if not wait:
+            return jsonify({
+                'message': 'Batch is being processed, poll the job for progress and the per-item results',
+                'job_id': job['job_id'],
+                'status': job['status'],
+                'status_url': f"/jobs/{job['job_id']}",
+            }), 202
+        job['future'].result()
+        if job['status'] == 'failed':
+            raise Exception(job['error'])
         return jsonify({
-            'message': 'URLs retrieved or generated successfully', 
-            'city': city_name,
-            'location_of_interest': location_of_interest,
-            'number_of_urls': len(urls),
-            'urls_previously_existed': urls_exist,
-            'generation_time': generation_time,
-            'urls': urls
+            'message': 'Batch processed',
+            **job['result'],
+            'elapsed_s': round(time.perf_counter() - start, 4),
         }), 200
     except Exception as e:
         return jsonify({'error': 'Internal server error', 'message': str(e)}), 500
 
-if __name__ == '__main__':
-  app.run(host='0.0.0.0')
+def migrate_keyword_collections(drop_old=False, workers=BATCH_WORKERS):
+    # The original code stored one '{keyword}_{City}_urls' collection of URL documents per keyword, in a
+    # '{keyword}_urls' database. Those grids used 69 points per degree, which matches no current grid, so
+    # nothing in them can be reused: each city found there gets the shared default grid built once instead,
+    # as a batch. With drop_old the old collections of every city whose grid is ready are dropped.
+    # Returns (cities ready, cities failed, collections dropped).
+    legacy = OrderedDict()  # city key -> (city name, [(db name, collection name)])
+    keywords = set()
+    client = get_mongo().cx
+    for db_name in client.list_database_names():
+        if not db_name.endswith('_urls'):
+            continue
+        keyword = db_name[:-len('_urls')]
+        for coll_name in client[db_name].list_collection_names():
+            if not (coll_name.startswith(f"{keyword}_") and coll_name.endswith('_urls')):
+                continue
+            city_name = coll_name[len(keyword) + 1:-len('_urls')].replace('_', ' ')
+            legacy.setdefault(PolygonCache.key(city_name), (city_name, []))[1].append((db_name, coll_name))
+            keywords.add(keyword)
+    if not legacy:
+        return 0, 0, 0
+
+    items = process_batch([city_name for city_name, _ in legacy.values()], sorted(keywords), workers=workers)
+    statuses = {PolygonCache.key(item['city']): item for item in items}
+    ready, failed, dropped = 0, 0, 0
+    for key, (city_name, collections) in legacy.items():
+        item = statuses[key]
+        if item['status'] == 'failed':
+            print(f"Could not build the grid for {city_name}, keeping its old collections: {item['error']}")
+            failed += 1
+            continue
+        print(f"Grid for {city_name} is {item['status']} with {item['number_of_urls']} points, replacing {len(collections)} old collections.")
+        ready += 1
+        if drop_old:
+            for db_name, coll_name in collections:
+                client[db_name].drop_collection(coll_name)
+                dropped += 1
+    return ready, failed, dropped
+
+def run_batch_cli(args):
+    with open(args.cities_file) as f:
+        city_names = [line.strip() for line in f if line.strip()]
+    keywords = [keyword.strip() for keyword in args.keywords.split(',') if keyword.strip()]
+    error = grid_options_error(args.spacing_m, args.layout, args.zoom)
+    if error:
+        sys.exit(error)
+    items = process_batch(city_names, keywords, args.spacing_m, args.layout, args.zoom, args.workers)
+    for item in items:
+        print(json.dumps(item))
+        if args.output and item['status'] != 'failed':
+            # Write the URLs as CSV, streamed from the stored grid
+            collection = grid_collection(item['city'], args.spacing_m, args.layout, args.zoom)
+            grid_points = load_grid_points(collection, load_metadata(collection))
+            os.makedirs(args.output, exist_ok=True)
+            filename = f"urls_{item['city'].replace(' ', '_')}_{item['location_of_interest'].replace(' ', '_')}.csv"
+            with open(os.path.join(args.output, filename), 'w', newline='') as f:
+                for piece in stream_urls(item['city'], item['location_of_interest'], grid_points, args.zoom, 'csv'):
+                    f.write(piece)
 
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Generate Google Maps search URLs covering a city.')
+  commands = parser.add_subparsers(dest='command')
+  migrate_parser = commands.add_parser('migrate', help='build the shared grid for every city in the old per-keyword collections')
+  migrate_parser.add_argument('--drop', action='store_true', help='drop the old collections of each city once its grid is ready')
+  migrate_parser.add_argument('--workers', type=int, default=BATCH_WORKERS, help='grid worker processes, one per core by default')
+  batch_parser = commands.add_parser('batch', help='build the grids for many cities and keywords')
+  batch_parser.add_argument('cities_file', help='file with one city name per line')
+  batch_parser.add_argument('--keywords', required=True, help='comma separated keywords')
+  batch_parser.add_argument('--spacing-m', type=float, default=None)
+  batch_parser.add_argument('--layout', default='square', choices=GRID_LAYOUTS)
+  batch_parser.add_argument('--zoom', type=int, default=DEFAULT_ZOOM)
+  batch_parser.add_argument('--workers', type=int, default=BATCH_WORKERS, help='grid worker processes, one per core by default')
+  batch_parser.add_argument('--output', help='directory to write one CSV of URLs per city and keyword')
+  args = parser.parse_args()
+  if os.environ.get('MONGO_URI') is None:
+    print("Please set the MONGO_URI environment variable.")
+    exit(1)
+  if args.command == 'migrate':
+    ready, failed, dropped = migrate_keyword_collections(drop_old=args.drop, workers=args.workers)
+    print(f"Grids ready for {ready} cities, {failed} failed, dropped {dropped} old collections.")
+  elif args.command == 'batch':
+    run_batch_cli(args)
+  else:
+    app.run(host='0.0.0.0')